@@ -7,7 +7,7 @@
 #
 # @author: Adi Zohar
 #
-# Supports Python  3
+# Supports Python 3.6+
 ##########################################################################
 # Info:
 #    List all compute tags in Tenancy
@@ -34,9 +34,11 @@
 #
 # APIs Used:
 # - IdentityClient.list_compartments         - Policy COMPARTMENT_INSPECT
+# - IdentityClient.get_compartment           - Policy COMPARTMENT_INSPECT
 # - IdentityClient.get_tenancy               - Policy TENANCY_INSPECT
 # - IdentityClient.list_region_subscriptions - Policy TENANCY_INSPECT
 # - ComputeClient.list_instances             - Policy
+# - ResourceSearchClient.search_resources    - Policy inspect on the searched resources
 #
 ##########################################################################
 # Application Command line parameters
@@ -50,6 +52,14 @@
 #   -deftag tag     - definetags
 #   -freetag tag    - freeform tag
 #   -deltag         - specify if to delete the tag
+#   -parallel_regions n      - number of regions to process in parallel (default 8)
+#   -parallel_compartments n - number of compartments to process in parallel per region (default 16)
+#   -rps n                   - limit OCI API calls per second, 0 for no limit (default 0)
+#   -print                   - print full report
+#   -out file                - stream report rows to file as JSON lines
+#   -search                  - use resource search to skip compartments without resources
+#   -nocache                 - do not use cached compartments and tag namespace from previous runs
+#   -parallel_updates n      - number of tag updates in flight per region (default 8)
 ##########################################################################
 
 from __future__ import print_function
@@ -59,14 +69,95 @@ import datetime
 import oci
 import json
 import os
+import logging
+import time
+import queue
+import collections
+import functools
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# orjson is optional, used to speed up the -out file writer
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 # global variables
 assign_tag_namespace = ""
 assign_tag_key = ""
 assign_tag_value = ""
-warnings = 0
-data = []
+tag_handler = None
 cmd = ""
+output_queue = None
+output_error = None
+
+# logger for progress and errors, records from parallel threads are written one at a time
+logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s', stream=sys.stdout)
+logger = logging.getLogger(__name__)
+
+# per thread storage for region clients
+thread_data = threading.local()
+
+# set on fatal error, running scans stop and no more tags are updated
+stop_event = threading.Event()
+
+# retry strategy for OCI calls, capped exponential backoff with jitter on throttling and 5xx,
+# conflicts on resources in transition are retried as in the SDK default strategy
+retry_strategy = oci.retry.RetryStrategyBuilder(
+    max_attempts_check=True,
+    max_attempts=8,
+    retry_max_wait_between_calls_seconds=30,
+    retry_base_sleep_time_seconds=1,
+    backoff_type=oci.retry.BACKOFF_EQUAL_JITTER_VALUE,
+    service_error_check=True,
+    service_error_retry_on_any_5xx=True,
+    service_error_retry_config={409: ['IncorrectState'], 429: []}
+).get_retry_strategy()
+
+# local cache of tenancy metadata between runs
+cache_dir = os.path.join("~", ".oci_tagger_cache")
+cache_ttl_seconds = 300
+cache_principal = ""
+
+# next time slot for the rate limiter, on the monotonic clock
+rate_limit_next = 0.0
+rate_limit_lock = threading.Lock()
+
+# report row of a scanned resource
+Row = collections.namedtuple('Row', ['region_name', 'compartment_name', 'type', 'name', 'defined_tags', 'freeform_tags', 'tags_process'])
+
+# resource types scanned per compartment and their report labels
+resource_types = {'instance': 'Instances', 'volume': 'Block Volumes', 'boot volume': 'Boot Volumes'}
+
+# resource search types and the matching scanned resource types
+search_resource_types = {'Instance': 'instance', 'Volume': 'volume', 'BootVolume': 'boot volume'}
+
+
+##########################################################################
+# Handler Result - report rows and counters of a scan, merged per
+# compartment and region instead of updating shared globals
+##########################################################################
+class HandlerResult:
+    __slots__ = ('rows', 'count', 'added', 'deleted', 'warnings', 'skipped')
+
+    def __init__(self):
+        self.rows = []
+        self.count = 0
+        self.added = 0
+        self.deleted = 0
+        self.warnings = 0
+        self.skipped = 0
+
+    def merge(self, other):
+        self.rows.extend(other.rows)
+        self.count += other.count
+        self.added += other.added
+        self.deleted += other.deleted
+        self.warnings += other.warnings
+        self.skipped += other.skipped
+        return self
 
 
 ##########################################################################
@@ -75,14 +166,14 @@ cmd = ""
 def print_banner(cmd, tenancy):
     print_header("Running Tag Conpute")
     print("Written By Adi Zohar, Nov 2020")
-    print("Starts at " + str(datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
-    print("Command Line  : " + ' '.join(x for x in sys.argv[1:]))
+    print(f"Starts at {datetime.datetime.now():%Y-%m-%d %H:%M:%S}")
+    print(f"Command Line  : {' '.join(sys.argv[1:])}")
     if cmd.deftag:
-        print("Tag Namespace : " + assign_tag_namespace)
-    print("Tag Key       : " + assign_tag_key)
-    print("Tag Value     : " + assign_tag_value)
-    print("Tenant Name   : " + str(tenancy.name))
-    print("Tenant Id     : " + tenancy.id)
+        print(f"Tag Namespace : {assign_tag_namespace}")
+    print(f"Tag Key       : {assign_tag_key}")
+    print(f"Tag Value     : {assign_tag_value}")
+    print(f"Tenant Name   : {tenancy.name}")
+    print(f"Tenant Id     : {tenancy.id}")
     print("")
 
 
@@ -93,7 +184,7 @@ def print_header(name):
     chars = int(90)
     print("")
     print('#' * chars)
-    print("#" + name.center(chars - 2, " ") + "#")
+    print(f"#{name.center(chars - 2, ' ')}#")
     print('#' * chars)
 
 
@@ -105,6 +196,7 @@ def command_line():
     global assign_tag_namespace
     global assign_tag_key
     global assign_tag_value
+    global tag_handler
 
     try:
         # Get Command Line Parser
@@ -119,6 +211,13 @@ def command_line():
         parser.add_argument('-ip', action='store_true', default=False, dest='is_instance_principals', help='Use Instance Principals for Authentication')
         parser.add_argument('-dt', action='store_true', default=False, dest='is_delegation_token', help='Use Delegation Token for Authentication')
         parser.add_argument('-print', action='store_true', default=False, dest='print_report', help='Print full Report')
+        parser.add_argument('-out', default="", dest='output_file', help='Stream report rows to file as JSON lines')
+        parser.add_argument('-search', action='store_true', default=False, dest='use_search', help='Use Resource Search to skip compartments without resources')
+        parser.add_argument('-parallel_updates', type=int, default=8, dest='parallel_updates', help='Number of tag updates in flight per region (default 8)')
+        parser.add_argument('-nocache', action='store_true', default=False, dest='no_cache', help='Do not use cached compartments and tag namespace from previous runs')
+        parser.add_argument('-parallel_regions', type=int, default=8, dest='parallel_regions', help='Number of regions to process in parallel (default 8)')
+        parser.add_argument('-parallel_compartments', type=int, default=16, dest='parallel_compartments', help='Number of compartments to process in parallel per region (default 16)')
+        parser.add_argument('-rps', type=float, default=0, dest='rps', help='Limit OCI API calls per second, 0 for no limit (default 0)')
         cmd = parser.parse_args()
 
         # Check if any tag specified
@@ -135,26 +234,27 @@ def command_line():
 
         # if defined tag
         if cmd.deftag:
-            assign_tag_namespace = cmd.deftag.split(".")[0]
-            assign_tag_key = cmd.deftag.split(".")[1].split("=")[0]
-            assign_tag_value = cmd.deftag.split(".")[1].split("=")[1]
-            if not (assign_tag_namespace or assign_tag_key or assign_tag_value):
+            assign_tag_namespace, dot, key_value = cmd.deftag.partition(".")
+            assign_tag_key, equal, assign_tag_value = key_value.partition("=")
+            if not (dot and equal and assign_tag_namespace and assign_tag_key):
                 print("Error with tag format, must be in format - namespace.key=value")
                 raise SystemExit
+            tag_handler = delete_defined_tag if cmd.deltag else add_defined_tag
 
         # if freeform tag
         if cmd.freetag:
-            assign_tag_key = cmd.freetag.split("=")[0]
-            assign_tag_value = cmd.freetag.split("=")[1]
-            if not (assign_tag_key or assign_tag_value):
+            assign_tag_key, equal, assign_tag_value = cmd.freetag.partition("=")
+            if not (equal and assign_tag_key):
                 print("Error with tag format, must be in format - key=value")
                 raise SystemExit
+            tag_handler = delete_freeform_tag if cmd.deltag else add_freeform_tag
 
         # return the command line
         return cmd
 
-    except Exception as e:
-        raise RuntimeError("Error in command_line: " + str(e.args))
+    except Exception:
+        logger.error("Error in command_line")
+        raise
 
 
 ##########################################################################
@@ -171,6 +271,151 @@ def check_service_error(code):
             )
 
 
+##########################################################################
+# Add report row to the result for the printed report and/or the output
+# file writer
+##########################################################################
+def add_row(result, row):
+    if cmd.print_report:
+        result.rows.append(row)
+    if output_queue and not output_error:
+        output_queue.put(row)
+
+
+##########################################################################
+# Output writer thread - write rows from the output queue as JSON lines
+# until None is received
+# On write error keep the error for main and drain the queue, so the
+# scanning threads never block on a full queue
+##########################################################################
+def output_writer(f):
+    global output_error
+
+    row = True
+    try:
+        with f:
+            while True:
+                row = output_queue.get()
+                if row is None:
+                    break
+                if orjson:
+                    f.write(orjson.dumps(row._asdict()))
+                else:
+                    f.write(json.dumps(row._asdict()).encode('utf-8'))
+                f.write(b"\n")
+
+    except Exception as e:
+        output_error = e
+        while row is not None:
+            row = output_queue.get()
+
+
+##########################################################################
+# Stop the run - flag running scans to stop and cancel the futures
+# which did not start yet
+##########################################################################
+def stop_run(futures):
+    stop_event.set()
+    for future in futures:
+        future.cancel()
+
+
+##########################################################################
+# Read pages of list call lazily and yield the records of each page
+# Yield None and stop if a service error should be reported as warning
+# Stop without more pages if the run is stopped
+##########################################################################
+def read_pages(list_func, *args, **kwargs):
+    pages = oci.pagination.list_call_get_all_results_generator(list_func, 'response', *args, **kwargs)
+    while not stop_event.is_set():
+        try:
+            page = next(pages)
+
+        except StopIteration:
+            return
+
+        except oci.exceptions.ServiceError as e:
+            if check_service_error(e.code):
+                yield None
+                return
+            raise
+
+        yield page.data
+
+
+##########################################################################
+# Principal of the signer, cached lists depend on what the caller can access
+##########################################################################
+def signer_principal(config):
+    if cmd.is_instance_principals:
+        principal = f"instance_principal_{config['tenancy']}"
+    elif cmd.is_delegation_token:
+        principal = f"delegation_token_{config.get('user') or os.environ.get('OCI_CONFIG_PROFILE')}"
+    else:
+        principal = f"user_{cmd.config_profile}_{config['user']}"
+    return hashlib.sha1(principal.encode('utf-8')).hexdigest()[:16]
+
+
+##########################################################################
+# Read value from the local cache if not older than the cache ttl,
+# otherwise call func and store its result for next runs
+# Cache files are kept per principal, name is printed when the cache is used
+##########################################################################
+def read_cached(name, key, func):
+    path = os.path.join(os.path.expanduser(cache_dir), f"{key}_{cache_principal}.json")
+
+    if not cmd.no_cache:
+        try:
+            age = time.time() - os.path.getmtime(path)
+            if age < cache_ttl_seconds:
+                with open(path, 'r') as f:
+                    value = json.load(f)
+                print(f"    Using cached {name} from {age:.0f} seconds ago, use -nocache to read them again")
+                return value
+        except (OSError, ValueError):
+            pass
+
+    value = func()
+
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump(value, f)
+    except OSError:
+        logger.warning("Could not write cache file %s", path)
+
+    return value
+
+
+##########################################################################
+# Rate limit - wait for the next free time slot when -rps is specified
+##########################################################################
+def rate_limit():
+    global rate_limit_next
+
+    if cmd.rps <= 0:
+        return
+
+    with rate_limit_lock:
+        now = time.monotonic()
+        wait = rate_limit_next - now
+        rate_limit_next = max(now, rate_limit_next) + 1.0 / cmd.rps
+
+    if wait > 0:
+        time.sleep(wait)
+
+
+##########################################################################
+# Wrap OCI call with rate limit and retry strategy
+##########################################################################
+def rate_limited(func):
+    def call(*args, **kwargs):
+        rate_limit()
+        kwargs.setdefault('retry_strategy', retry_strategy)
+        return func(*args, **kwargs)
+    return call
+
+
 ##########################################################################
 # Create signer for Authentication
 # Input - config_profile and is_instance_principals and is_delegation_token
@@ -207,7 +452,7 @@ def create_signer(config_profile, is_instance_principals, is_delegation_token):
 
             # check if file exist
             if not os.path.isfile(env_config_file):
-                print("*** Config File " + env_config_file + " does not exist, Abort. ***")
+                print(f"*** Config File {env_config_file} does not exist, Abort. ***")
                 print("")
                 raise SystemExit
 
@@ -253,49 +498,58 @@ def create_signer(config_profile, is_instance_principals, is_delegation_token):
 def read_tag_namespaces(identity, tenancy):
     try:
         print("\nReading Tag Namespaces...")
-        tagnamespaces = oci.pagination.list_call_get_all_results(
-            identity.list_tag_namespaces,
-            tenancy.id,
-            include_subcompartments=True,
-            lifecycle_state='ACTIVE'
-        ).data
-
-        ###########################
-        # check if namespace exit
-        ###########################
-        assign_tag_namespace_obj = None
-        for tagnamespace in tagnamespaces:
-            if tagnamespace.name == assign_tag_namespace:
-                assign_tag_namespace_obj = tagnamespace
-                print("   Found Tag Namespace '" + assign_tag_namespace + "', id = " + tagnamespace.id)
-                break
-
-        if not assign_tag_namespace_obj:
-            print("Could not find tag namespace " + assign_tag_namespace)
-            print("Abort.")
-            raise SystemExit
-
-        # check tag key
-        tags = oci.pagination.list_call_get_all_results(
-            identity.list_tags,
-            assign_tag_namespace_obj.id,
-            lifecycle_state='ACTIVE'
-        ).data
+        tag = read_cached(
+            "tag ids",
+            f"tag_{tenancy.id}_{assign_tag_namespace}.{assign_tag_key}",
+            lambda: find_tag(identity, tenancy)
+        )
+        print(f"   Found Tag Namespace '{assign_tag_namespace}', id = {tag['namespace_id']}")
+        print(f"   Found Tag Key '{assign_tag_key}', id = {tag['tag_id']}")
 
-        tag_key_found = False
-        for tag in tags:
-            if tag.name == assign_tag_key:
-                tag_key_found = True
-                print("   Found Tag Key '" + assign_tag_key + "', id = " + tag.id)
-                break
+    except Exception:
+        logger.error("Error checking tag namespace %s", assign_tag_namespace)
+        raise
 
-        if not tag_key_found:
-            print("Could not find tag Key " + assign_tag_key)
-            print("Abort.")
-            raise SystemExit
 
-    except Exception as e:
-        raise RuntimeError("\nError checking tagnamespace - " + str(e))
+##########################################################################
+# Find tag namespace and tag key ids, abort if not exist
+##########################################################################
+def find_tag(identity, tenancy):
+    tagnamespaces = oci.pagination.list_call_get_all_results(
+        identity.list_tag_namespaces,
+        tenancy.id,
+        include_subcompartments=True,
+        lifecycle_state='ACTIVE'
+    ).data
+
+    ###########################
+    # check if namespace exit
+    ###########################
+    assign_tag_namespace_obj = None
+    for tagnamespace in tagnamespaces:
+        if tagnamespace.name == assign_tag_namespace:
+            assign_tag_namespace_obj = tagnamespace
+            break
+
+    if not assign_tag_namespace_obj:
+        print(f"Could not find tag namespace {assign_tag_namespace}")
+        print("Abort.")
+        raise SystemExit
+
+    # check tag key
+    tags = oci.pagination.list_call_get_all_results(
+        identity.list_tags,
+        assign_tag_namespace_obj.id,
+        lifecycle_state='ACTIVE'
+    ).data
+
+    for tag in tags:
+        if tag.name == assign_tag_key:
+            return {'namespace_id': assign_tag_namespace_obj.id, 'tag_id': tag.id}
+
+    print(f"Could not find tag Key {assign_tag_key}")
+    print("Abort.")
+    raise SystemExit
 
 
 ##########################################################################
@@ -305,11 +559,44 @@ def identity_read_compartments(identity, tenancy):
 
     print("Loading Compartments...")
     try:
-        compartments = oci.pagination.list_call_get_all_results(
-            identity.list_compartments,
-            tenancy.id,
-            compartment_id_in_subtree=True,
-        ).data
+        # if filter by compartment id, read only that compartment instead of the whole tenancy
+        if cmd.compartment == tenancy.id:
+            print("    Total 1 compartments loaded.")
+            return [tenancy]
+
+        # unknown, inaccessible or other tenancy compartment loads nothing
+        if cmd.compartment.startswith("ocid1.compartment."):
+            filtered_compartment = []
+            try:
+                compartment = identity.get_compartment(cmd.compartment).data
+                if compartment.lifecycle_state == oci.identity.models.Compartment.LIFECYCLE_STATE_ACTIVE and \
+                        compartment_in_tenancy(identity, compartment, tenancy):
+                    filtered_compartment.append(compartment)
+
+            # only not found or not authorized loads nothing, throttling and other errors abort
+            except oci.exceptions.ServiceError as e:
+                if e.status != 404:
+                    raise
+
+            print(f"    Total {len(filtered_compartment)} compartments loaded.")
+            return filtered_compartment
+
+        # only active and accessible compartments are returned by the service
+        cached_compartments = read_cached(
+            "compartments",
+            f"compartments_{tenancy.id}",
+            lambda: [{'id': c.id, 'name': c.name} for c in oci.pagination.list_call_get_all_results(
+                identity.list_compartments,
+                tenancy.id,
+                compartment_id_in_subtree=True,
+                lifecycle_state=oci.identity.models.Compartment.LIFECYCLE_STATE_ACTIVE,
+                access_level="ACCESSIBLE"
+            ).data]
+        )
+        compartments = [
+            oci.identity.models.Compartment(id=c['id'], name=c['name'], lifecycle_state=oci.identity.models.Compartment.LIFECYCLE_STATE_ACTIVE)
+            for c in cached_compartments
+        ]
 
         # Add root compartment which is not part of the list_compartments
         compartments.append(tenancy)
@@ -317,10 +604,6 @@ def identity_read_compartments(identity, tenancy):
         # compile new compartment object
         filtered_compartment = []
         for compartment in compartments:
-            # skip non active compartments
-            if compartment.id != tenancy.id and compartment.lifecycle_state != oci.identity.models.Compartment.LIFECYCLE_STATE_ACTIVE:
-                continue
-
             # if filter by compartment name or id if specified
             if cmd.compartment:
                 if compartment.id != cmd.compartment and compartment.name != cmd.compartment:
@@ -328,203 +611,143 @@ def identity_read_compartments(identity, tenancy):
 
             filtered_compartment.append(compartment)
 
-        print("    Total " + str(len(filtered_compartment)) + " compartments loaded.")
+        print(f"    Total {len(filtered_compartment)} compartments loaded.")
         return filtered_compartment
 
-    except Exception as e:
-        raise RuntimeError("Error in identity_read_compartments: " + str(e.args))
+    except Exception:
+        logger.error("Error in identity_read_compartments")
+        raise
 
 
 ##########################################################################
-# Handle Instances
+# Check if compartment belongs to the tenancy by walking up its parents
 ##########################################################################
-def handle_instances(client, compartment, region_name):
+def compartment_in_tenancy(identity, compartment, tenancy):
+    parent_id = compartment.compartment_id
+    while parent_id and parent_id != tenancy.id:
+        parent_id = identity.get_compartment(parent_id).data.compartment_id
+    return parent_id == tenancy.id
 
-    global data
-    global warnings
 
+##########################################################################
+# Handle Instances
+##########################################################################
+def handle_instances(client, compartment, region_name, update_tags):
+
+    pending_updates = collections.deque()
     try:
-        cnt = 0
-        cnt_added = 0
-        cnt_deleted = 0
+        result = HandlerResult()
 
         ############################################
         # Retrieve instances
         ############################################
-        array = []
-        try:
-            array = oci.pagination.list_call_get_all_results(
-                client.list_instances,
-                compartment.id,
-                sort_by="DISPLAYNAME"
-            ).data
+        # read page by page so records are processed as pages arrive
+        for array in read_pages(rate_limited(client.list_instances), compartment.id, sort_by="DISPLAYNAME"):
+            if array is None:
+                result.warnings += 1
+                break
 
-        except oci.exceptions.ServiceError as e:
-            if check_service_error(e.code):
-                warnings += 1
-                print("        Instances...Warnings ")
-                return
-            raise
+            # loop on Array
+            for arr in array:
+                if arr.lifecycle_state == "TERMINATING" or arr.lifecycle_state == "TERMINATED":
+                    continue
 
-        # loop on Array
-        for arr in array:
-            if arr.lifecycle_state == "TERMINATING" or arr.lifecycle_state == "TERMINATED":
-                continue
+                defined_tags, freeform_tags, tags_process = handle_tags(arr.defined_tags, arr.freeform_tags)
 
-            defined_tags, freeform_tags, tags_process = handle_tags(arr.defined_tags, arr.freeform_tags)
-
-            # if tag modified:
-            if tags_process:
-                client.update_instance(
-                    arr.id,
-                    oci.core.models.UpdateInstanceDetails(
-                        freeform_tags=freeform_tags,
-                        defined_tags=defined_tags
-                    )
-                )
-
-            ############################################
-            # Add data to array
-            ############################################
-            value = ({
-                'region_name': region_name,
-                'compartment_name': str(compartment.name),
-                'type': 'instance',
-                'name': str(arr.display_name),
-                'defined_tags': defined_tags,
-                'freeform_tags': freeform_tags,
-                'tags_process': tags_process
-            })
-
-            data.append(value)
-            cnt += 1
-
-            if tags_process == "Added":
-                cnt_added += 1
-            if tags_process == "Deleted":
-                cnt_deleted += 1
-
-        # print instances for the compartment
-        if cnt == 0:
-            print("        Instances (-)")
-        else:
-            if cmd.deltag:
-                print("        Instances     - " + str(cnt) + ", Tag Deleted = " + str(cnt_deleted))
-            else:
-                print("        Instances     - " + str(cnt) + ", Tag Added = " + str(cnt_added))
+                # if tag modified, queue the update on the region update pool
+                if tags_process:
+                    queue_update(pending_updates, update_tags('instance', arr.id, freeform_tags, defined_tags))
 
-    except Exception as e:
-        raise RuntimeError("Error in handle_instances: " + str(e.args))
+                ############################################
+                # Add data to report, only if requested
+                ############################################
+                if cmd.print_report or cmd.output_file:
+                    add_row(result, Row(region_name, compartment.name, 'instance', arr.display_name or "", defined_tags, freeform_tags, tags_process))
+
+                result.count += 1
+
+                if tags_process == "Added":
+                    result.added += 1
+                if tags_process == "Deleted":
+                    result.deleted += 1
+
+        # wait for the tag updates of this scan
+        for future in pending_updates:
+            future.result()
+
+        return result
+
+    except Exception:
+        stop_run(pending_updates)
+        logger.error("Error in handle_instances, region %s, compartment %s", region_name, compartment.name)
+        raise
 
 
 ##########################################################################
 # Handle Instances
 ##########################################################################
-def handle_block_volumes(client, compartment, region_name):
-
-    global data
-    global warnings
+def handle_block_volumes(client, compartment, region_name, update_tags):
 
+    pending_updates = collections.deque()
     try:
-        cnt = 0
-        cnt_added = 0
-        cnt_deleted = 0
+        result = HandlerResult()
 
-        array = []
-        try:
-            array = oci.pagination.list_call_get_all_results(
-                client.list_volumes,
-                compartment.id,
-                sort_by="DISPLAYNAME"
-            ).data
+        # read page by page so records are processed as pages arrive
+        for array in read_pages(rate_limited(client.list_volumes), compartment.id, sort_by="DISPLAYNAME"):
+            if array is None:
+                result.warnings += 1
+                break
 
-        except oci.exceptions.ServiceError as e:
-            if check_service_error(e.code):
-                warnings += 1
-                print("        Block Volumes...Warnings ")
-                return
-            raise
+            # loop on Array
+            for arr in array:
+                if arr.lifecycle_state == "TERMINATING" or arr.lifecycle_state == "TERMINATED":
+                    continue
 
-        # loop on Array
-        for arr in array:
-            if arr.lifecycle_state == "TERMINATING" or arr.lifecycle_state == "TERMINATED":
-                continue
+                defined_tags, freeform_tags, tags_process = handle_tags(arr.defined_tags, arr.freeform_tags)
 
-            defined_tags, freeform_tags, tags_process = handle_tags(arr.defined_tags, arr.freeform_tags)
-
-            # if tag modified:
-            if tags_process:
-                client.update_volume(
-                    arr.id,
-                    oci.core.models.UpdateVolumeDetails(
-                        freeform_tags=freeform_tags,
-                        defined_tags=defined_tags
-                    )
-                )
-
-            ############################################
-            # Add data to array
-            ############################################
-            value = ({
-                'region_name': region_name,
-                'compartment_name': str(compartment.name),
-                'type': 'volume',
-                'name': str(arr.display_name),
-                'defined_tags': defined_tags,
-                'freeform_tags': freeform_tags,
-                'tags_process': tags_process
-            })
-
-            data.append(value)
-            cnt += 1
-
-            if tags_process == "Added":
-                cnt_added += 1
-            if tags_process == "Deleted":
-                cnt_deleted += 1
-
-        # print instances for the compartment
-        if cnt == 0:
-            print("        Block Volumes (-)")
-        else:
-            if cmd.deltag:
-                print("        Block Volumes - " + str(cnt) + ", Tag Deleted = " + str(cnt_deleted))
-            else:
-                print("        Block Volumes - " + str(cnt) + ", Tag Added = " + str(cnt_added))
+                # if tag modified, queue the update on the region update pool
+                if tags_process:
+                    queue_update(pending_updates, update_tags('volume', arr.id, freeform_tags, defined_tags))
 
-    except Exception as e:
-        raise RuntimeError("Error in handle_block_volumes: " + str(e.args))
+                ############################################
+                # Add data to report, only if requested
+                ############################################
+                if cmd.print_report or cmd.output_file:
+                    add_row(result, Row(region_name, compartment.name, 'volume', arr.display_name or "", defined_tags, freeform_tags, tags_process))
+
+                result.count += 1
+
+                if tags_process == "Added":
+                    result.added += 1
+                if tags_process == "Deleted":
+                    result.deleted += 1
+
+        # wait for the tag updates of this scan
+        for future in pending_updates:
+            future.result()
+
+        return result
+
+    except Exception:
+        stop_run(pending_updates)
+        logger.error("Error in handle_block_volumes, region %s, compartment %s", region_name, compartment.name)
+        raise
 
 
 ##########################################################################
 # Handle Instances
 ##########################################################################
-def handle_boot_volumes(identity, tenancy_id, client, compartment, region_name):
-
-    global data
-    global warnings
+def handle_boot_volumes(client, compartment, region_name, availability_domain, update_tags):
 
+    pending_updates = collections.deque()
     try:
-        cnt = 0
-        cnt_added = 0
-        cnt_deleted = 0
-
-        array = []
-        availability_domains = identity.list_availability_domains(tenancy_id).data
-        for ad in availability_domains:
-            try:
-                array = oci.pagination.list_call_get_all_results(
-                    client.list_boot_volumes,
-                    ad.name,
-                    compartment.id
-                ).data
+        result = HandlerResult()
 
-            except oci.exceptions.ServiceError as e:
-                if check_service_error(e.code):
-                    warnings += 1
-                    print("        Boot Volumes...Warnings ")
-                    return
-                raise
+        # read page by page so records are processed as pages arrive
+        for array in read_pages(rate_limited(client.list_boot_volumes), availability_domain.name, compartment.id):
+            if array is None:
+                result.warnings += 1
+                break
 
             # loop on Array
             for arr in array:
@@ -533,115 +756,387 @@ def handle_boot_volumes(identity, tenancy_id, client, compartment, region_name):
 
                 defined_tags, freeform_tags, tags_process = handle_tags(arr.defined_tags, arr.freeform_tags)
 
-                # if tag modified:
+                # if tag modified, queue the update on the region update pool
                 if tags_process:
-                    client.update_boot_volume(
-                        arr.id,
-                        oci.core.models.UpdateBootVolumeDetails(
-                            freeform_tags=freeform_tags,
-                            defined_tags=defined_tags
-                        )
-                    )
+                    queue_update(pending_updates, update_tags('boot volume', arr.id, freeform_tags, defined_tags))
 
                 ############################################
-                # Add data to array
+                # Add data to report, only if requested
                 ############################################
-                value = ({
-                    'region_name': region_name,
-                    'compartment_name': str(compartment.name),
-                    'type': 'boot volume',
-                    'name': str(arr.display_name),
-                    'defined_tags': defined_tags,
-                    'freeform_tags': freeform_tags,
-                    'tags_process': tags_process
-                })
-
-                data.append(value)
-                cnt += 1
+                if cmd.print_report or cmd.output_file:
+                    add_row(result, Row(region_name, compartment.name, 'boot volume', arr.display_name or "", defined_tags, freeform_tags, tags_process))
+
+                result.count += 1
 
                 if tags_process == "Added":
-                    cnt_added += 1
+                    result.added += 1
                 if tags_process == "Deleted":
-                    cnt_deleted += 1
+                    result.deleted += 1
 
-        # print instances for the compartment
-        if cnt == 0:
-            print("        Boot Volumes (-)")
-        else:
-            if cmd.deltag:
-                print("        Boot Volumes  - " + str(cnt) + ", Tag Deleted = " + str(cnt_deleted))
-            else:
-                print("        Boot Volumes  - " + str(cnt) + ", Tag Added = " + str(cnt_added))
+        # wait for the tag updates of this scan
+        for future in pending_updates:
+            future.result()
 
-    except Exception as e:
-        raise RuntimeError("Error in handle_boot_volumes: " + str(e.args))
+        return result
+
+    except Exception:
+        stop_run(pending_updates)
+        logger.error("Error in handle_boot_volumes, region %s, compartment %s", region_name, compartment.name)
+        raise
+
+
+##########################################################################
+# Keep the future of a queued tag update, drop the finished ones so
+# only the updates in flight are held
+##########################################################################
+def queue_update(pending_updates, future):
+    pending_updates.append(future)
+    while pending_updates and pending_updates[0].done():
+        pending_updates.popleft().result()
+
+
+##########################################################################
+# Add defined tag
+##########################################################################
+def add_defined_tag(defined_tags, freeform_tags):
+    if defined_tags.get(assign_tag_namespace, {}).get(assign_tag_key) == assign_tag_value:
+        return defined_tags, freeform_tags, ""
+
+    defined_tags[assign_tag_namespace] = {assign_tag_key: assign_tag_value}
+    return defined_tags, freeform_tags, "Added"
+
+
+##########################################################################
+# Delete defined tag
+##########################################################################
+def delete_defined_tag(defined_tags, freeform_tags):
+    if defined_tags.get(assign_tag_namespace, {}).get(assign_tag_key) == assign_tag_value:
+        defined_tags.pop(assign_tag_namespace, None)
+        return defined_tags, freeform_tags, "Deleted"
+
+    return defined_tags, freeform_tags, ""
+
+
+##########################################################################
+# Add freeform tag
+##########################################################################
+def add_freeform_tag(defined_tags, freeform_tags):
+    if freeform_tags.get(assign_tag_key) == assign_tag_value:
+        return defined_tags, freeform_tags, ""
+
+    freeform_tags[assign_tag_key] = assign_tag_value
+    return defined_tags, freeform_tags, "Added"
+
+
+##########################################################################
+# Delete freeform tag
+##########################################################################
+def delete_freeform_tag(defined_tags, freeform_tags):
+    if freeform_tags.get(assign_tag_key) == assign_tag_value:
+        freeform_tags.pop(assign_tag_key, None)
+        return defined_tags, freeform_tags, "Deleted"
+
+    return defined_tags, freeform_tags, ""
 
 
 ##########################################################################
 # Handle Tag
+# tag_handler is selected once in command_line() based on the tag type
 ##########################################################################
 def handle_tags(defined_tags, freeform_tags):
     try:
-        tags_process = ""
+        return tag_handler(defined_tags, freeform_tags)
 
-        ############################################
-        # handle defined tags
-        ############################################
-        if cmd.deftag:
-            defined_tags_exist = False
-            if assign_tag_namespace in defined_tags:
-                if assign_tag_key in defined_tags[assign_tag_namespace]:
-                    if defined_tags[assign_tag_namespace][assign_tag_key] == assign_tag_value:
-                        defined_tags_exist = True
-
-            # Del Key
-            if cmd.deltag:
-                if defined_tags_exist:
-                    defined_tags.pop(assign_tag_namespace, None)
-                    tags_process = "Deleted"
-
-            # Add Key
-            else:
-                if not defined_tags_exist:
-                    defined_tags[assign_tag_namespace] = {assign_tag_key: assign_tag_value}
-                    tags_process = "Added"
+    except Exception:
+        logger.error("Error in handle_tags")
+        raise
 
-        ############################################
-        # handle freeform tags
-        ############################################
-        if cmd.freetag:
-            freeform_tags_exist = False
-            if assign_tag_key in freeform_tags:
-                if freeform_tags[assign_tag_key] == assign_tag_value:
-                    freeform_tags_exist = True
-
-            # Del Key
-            if cmd.deltag:
-                if freeform_tags_exist:
-                    freeform_tags.pop(assign_tag_key, None)
-                    tags_process = "Deleted"
-
-            # Add Key
-            else:
-                if not freeform_tags_exist:
-                    freeform_tags[assign_tag_key] = assign_tag_value
-                    tags_process = "Added"
-
-        # return modified tags
-        return defined_tags, freeform_tags, tags_process
 
-    except Exception as e:
-        raise RuntimeError("Error in handle_tags: " + str(e.args))
+##########################################################################
+# Get region clients
+# Clients are kept per thread so each worker reuses its own session
+##########################################################################
+def get_region_clients(region_config, signer):
+
+    region_name = region_config['region']
+    clients = getattr(thread_data, 'clients', None)
+    if clients is None:
+        clients = thread_data.clients = {}
+
+    if region_name not in clients:
+
+        # connect to ComputeClient
+        compute_client = oci.core.ComputeClient(region_config, signer=signer)
+        if cmd.proxy:
+            compute_client.base_client.session.proxies = {'https': cmd.proxy}
+
+        # connect to BlockstorageClient, both clients call the same core services endpoint
+        # so share the compute session and its keep-alive connections for list and update calls
+        blockstorage_client = oci.core.BlockstorageClient(region_config, signer=signer)
+        blockstorage_client.base_client.session = compute_client.base_client.session
+
+        clients[region_name] = (compute_client, blockstorage_client)
+
+    return clients[region_name]
+
+
+##########################################################################
+# Format status line of resource type in compartment
+##########################################################################
+def format_status(label, result):
+    if result.warnings:
+        return f"        {label}...Warnings "
+    if result.count == 0:
+        if result.skipped:
+            return f"        {label} (skipped by search)"
+        return f"        {label} (-)"
+    if cmd.deltag:
+        return f"        {label:<13} - {result.count}, Tag Deleted = {result.deleted}"
+    return f"        {label:<13} - {result.count}, Tag Added = {result.added}"
+
+
+##########################################################################
+# Process Resource
+# Scan one resource type in a compartment (and availability domain for
+# boot volumes) and return its result
+##########################################################################
+def process_resource(resource_type, region_config, signer, update_executor, update_slots, compartment, availability_domain=None):
+
+    if stop_event.is_set():
+        return HandlerResult()
+
+    region_name = region_config['region']
+    try:
+        compute_client, blockstorage_client = get_region_clients(region_config, signer)
+        update_tags = functools.partial(submit_update, update_executor, update_slots, region_config, signer)
+
+        if resource_type == 'instance':
+            return handle_instances(compute_client, compartment, region_name, update_tags)
+        if resource_type == 'volume':
+            return handle_block_volumes(blockstorage_client, compartment, region_name, update_tags)
+        return handle_boot_volumes(blockstorage_client, compartment, region_name, availability_domain, update_tags)
+
+    except Exception:
+        # stop the other scans now instead of when this future is collected
+        stop_event.set()
+        raise
+
+
+##########################################################################
+# Submit tag update of resource to the region update pool
+# Wait for a free update slot first so the pool queue stays bounded,
+# the slot is released when the update is done or cancelled
+# Return the future of the update
+##########################################################################
+def submit_update(update_executor, update_slots, region_config, signer, resource_type, resource_id, freeform_tags, defined_tags):
+    update_slots.acquire()
+    try:
+        future = update_executor.submit(update_resource_tags, region_config, signer, resource_type, resource_id, freeform_tags, defined_tags)
+    except Exception:
+        update_slots.release()
+        raise
+
+    future.add_done_callback(lambda f: update_slots.release())
+    return future
+
+
+##########################################################################
+# Update resource tags, runs on the region update pool threads
+##########################################################################
+def update_resource_tags(region_config, signer, resource_type, resource_id, freeform_tags, defined_tags):
+
+    if stop_event.is_set():
+        return
+
+    compute_client, blockstorage_client = get_region_clients(region_config, signer)
+
+    if resource_type == 'instance':
+        rate_limited(compute_client.update_instance)(
+            resource_id,
+            oci.core.models.UpdateInstanceDetails(
+                freeform_tags=freeform_tags,
+                defined_tags=defined_tags
+            )
+        )
+
+    elif resource_type == 'volume':
+        rate_limited(blockstorage_client.update_volume)(
+            resource_id,
+            oci.core.models.UpdateVolumeDetails(
+                freeform_tags=freeform_tags,
+                defined_tags=defined_tags
+            )
+        )
+
+    else:
+        rate_limited(blockstorage_client.update_boot_volume)(
+            resource_id,
+            oci.core.models.UpdateBootVolumeDetails(
+                freeform_tags=freeform_tags,
+                defined_tags=defined_tags
+            )
+        )
+
+
+##########################################################################
+# Search resources in region
+# Return dict of (compartment_id, resource_type) to set of availability
+# domains holding resources, or None if all compartments should be scanned
+##########################################################################
+def search_region_resources(region_config, signer):
+
+    if not cmd.use_search:
+        return None
+
+    try:
+        search_client = oci.resource_search.ResourceSearchClient(region_config, signer=signer)
+        if cmd.proxy:
+            search_client.base_client.session.proxies = {'https': cmd.proxy}
+
+        resources = oci.pagination.list_call_get_all_results(
+            rate_limited(search_client.search_resources),
+            oci.resource_search.models.StructuredSearchDetails(
+                type="Structured",
+                query="query instance, volume, bootvolume resources"
+            )
+        ).data
+
+    except oci.exceptions.ServiceError as e:
+        if check_service_error(e.code):
+            logger.warning("%s - Resource search failed, scanning all compartments", region_config['region'])
+            return None
+        raise
+
+    hits = {}
+    for resource in resources:
+        resource_type = search_resource_types.get(resource.resource_type)
+        if resource_type:
+            ads = hits.setdefault((resource.compartment_id, resource_type), set())
+            if resource.availability_domain:
+                ads.add(resource.availability_domain)
+    return hits
+
+
+##########################################################################
+# Check if search found resources of type in compartment (and domain)
+##########################################################################
+def has_resources(hits, compartment_id, resource_type, availability_domain=None):
+    if hits is None:
+        return True
+
+    ads = hits.get((compartment_id, resource_type))
+    if ads is None:
+        return False
+    if availability_domain is None or not ads:
+        return True
+    return availability_domain in ads
+
+
+##########################################################################
+# Process Region
+# Each region gets its own config copy and clients so regions can run
+# in parallel without touching the shared config and signer
+##########################################################################
+def process_region(region_name, config, signer, compartments, tenancy):
+
+    # run stopped on error in another region, nothing is read or reported
+    if stop_event.is_set():
+        return HandlerResult()
+
+    logger.info("Region %s...", region_name)
+
+    # set the region in a copy of the config
+    region_config = dict(config)
+    region_config['region'] = region_name
+
+    # availability domains depend on the region only, read them once per region
+    try:
+        identity = oci.identity.IdentityClient(region_config, signer=signer)
+        if cmd.proxy:
+            identity.base_client.session.proxies = {'https': cmd.proxy}
+        availability_domains = rate_limited(identity.list_availability_domains)(tenancy.id).data
+
+    except Exception:
+        logger.error("Error reading availability domains in region %s", region_name)
+        stop_event.set()
+        raise
+
+    # find the compartments holding resources, so empty ones are not scanned
+    hits = search_region_resources(region_config, signer)
+    if stop_event.is_set():
+        return HandlerResult()
+
+    ############################################
+    # Process compartments and resource types in parallel
+    ############################################
+    region_result = HandlerResult()
+    update_slots = threading.BoundedSemaphore(max(1, cmd.parallel_updates) * 2)
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, cmd.parallel_updates)) as update_executor, \
+                ThreadPoolExecutor(max_workers=max(1, cmd.parallel_compartments)) as executor:
+            # submit every resource type of every compartment so the scans run concurrently,
+            # boot volumes are listed per availability domain so each domain is a separate scan,
+            # resource types that search did not find in the compartment are skipped
+            compartment_futures = []
+            all_futures = []
+            for compartment in compartments:
+                futures = {}
+                skipped = dict.fromkeys(resource_types, 0)
+                for resource_type in resource_types:
+                    futures[resource_type] = []
+                    if resource_type == 'boot volume':
+                        for ad in availability_domains:
+                            if has_resources(hits, compartment.id, resource_type, ad.name):
+                                futures[resource_type].append(executor.submit(process_resource, resource_type, region_config, signer, update_executor, update_slots, compartment, ad))
+                            else:
+                                skipped[resource_type] += 1
+                    elif has_resources(hits, compartment.id, resource_type):
+                        futures[resource_type].append(executor.submit(process_resource, resource_type, region_config, signer, update_executor, update_slots, compartment))
+                    else:
+                        skipped[resource_type] += 1
+                compartment_futures.append((compartment, futures, skipped))
+                for resource_futures in futures.values():
+                    all_futures.extend(resource_futures)
+
+            # log each compartment block as one record, in compartment order,
+            # once the run is stopped the scans are cut short so their counts are not logged,
+            # on error stop the other scans before leaving the pools
+            try:
+                for compartment, futures, skipped in compartment_futures:
+                    lines = [f"{region_name} - Compartment {compartment.name}"]
+                    for resource_type, label in resource_types.items():
+                        result = HandlerResult()
+                        result.skipped = skipped[resource_type]
+                        for future in futures[resource_type]:
+                            result.merge(future.result())
+                        region_result.merge(result)
+                        lines.append(format_status(label, result))
+                    if not stop_event.is_set():
+                        logger.info("\n".join(lines))
+            except Exception:
+                stop_run(all_futures)
+                raise
+
+    except Exception:
+        logger.error("Error extracting resources in region %s", region_name)
+        stop_event.set()
+        raise
+
+    return region_result
 
 
 ##########################################################################
 # Main
 ##########################################################################
 def main():
+    global output_queue
+    global cache_principal
+
     cmd = command_line()
 
     # Identity extract compartments
     config, signer = create_signer(cmd.config_profile, cmd.is_instance_principals, cmd.is_delegation_token)
+    cache_principal = signer_principal(config)
     compartments = []
     tenancy = None
     try:
@@ -654,8 +1149,9 @@ def main():
         regions = identity.list_region_subscriptions(tenancy.id).data
         compartments = identity_read_compartments(identity, tenancy)
 
-    except Exception as e:
-        raise RuntimeError("\nError extracting compartments section - " + str(e))
+    except Exception:
+        logger.error("Error extracting compartments section")
+        raise
 
     ############################################
     # Print Banner
@@ -669,61 +1165,72 @@ def main():
         read_tag_namespaces(identity, tenancy)
 
     ############################################
-    # Loop on all regions
+    # Process all regions in parallel
     ############################################
     print("\nProcessing Regions...")
-    data = []
-    warnings = 0
-    for region_name in [str(es.region_name) for es in regions]:
+    region_names = []
+    for region_name in [es.region_name for es in regions]:
 
         # check if filter by region
         if cmd.region:
             if cmd.region not in region_name:
                 continue
 
-        print("\nRegion " + region_name + "...")
+        region_names.append(region_name)
 
-        # set the region in the config and signer
-        config['region'] = region_name
-        signer.region = region_name
+    # open the output file before scanning so a bad path fails fast,
+    # then start the writer, bounded queue keeps memory flat
+    report = HandlerResult()
+    writer = None
+    if cmd.output_file:
+        output_file = open(cmd.output_file, 'wb')
+        output_queue = queue.Queue(maxsize=10000)
+        writer = threading.Thread(target=output_writer, args=(output_file,))
+        writer.start()
 
-        # connect to ComputeClient
-        compute_client = oci.core.ComputeClient(config, signer=signer)
-        if cmd.proxy:
-            compute_client.base_client.session.proxies = {'https': cmd.proxy}
-
-        # connect to BlockstorageClient
-        blockstorage_client = oci.core.BlockstorageClient(config, signer=signer)
-        if cmd.proxy:
-            blockstorage_client.base_client.session.proxies = {'https': cmd.proxy}
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, cmd.parallel_regions)) as executor:
+            futures = [executor.submit(process_region, region_name, config, signer, compartments, tenancy) for region_name in region_names]
 
-        ############################################
-        # Loop on all compartments for instances
-        ############################################
-        try:
-            for compartment in compartments:
+            # merge in region order so the report is the same on every run,
+            # on error stop the other regions before leaving the pool
+            try:
+                for future in futures:
+                    report.merge(future.result())
+            except Exception:
+                stop_run(futures)
+                raise
 
-                print("    Compartment " + str(compartment.name))
-                handle_instances(compute_client, compartment, region_name)
-                handle_block_volumes(blockstorage_client, compartment, region_name)
-                handle_boot_volumes(identity, tenancy.id, blockstorage_client, compartment, region_name)
+    finally:
+        if writer:
+            output_queue.put(None)
+            writer.join()
 
-        except Exception as e:
-            raise RuntimeError("\nError extracting Instances - " + str(e))
+    # report the writer error after all rows were produced
+    if output_error:
+        logger.error("Error writing output file %s", cmd.output_file)
+        raise output_error
 
     ############################################
     # Print Output as JSON
     ############################################
     if cmd.print_report:
         print_header("Output")
-        print(json.dumps(data, indent=4, sort_keys=False))
+        print(json.dumps([row._asdict() for row in report.rows], indent=4, sort_keys=False))
 
-    if warnings > 0:
-        print_header(str(warnings) + " Warnings appeared")
-    print_header("Completed at " + str(datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
+    if report.warnings > 0:
+        print_header(f"{report.warnings} Warnings appeared")
+    if report.skipped > 0:
+        print_header(f"{report.skipped} Scans skipped by resource search")
+    print_header(f"Completed at {datetime.datetime.now():%Y-%m-%d %H:%M:%S}")
 
 
 ############################################
 # Execute
 ############################################
-main()
+try:
+    main()
+
+except Exception:
+    logger.exception("Tag resources failed")
+    raise SystemExit(1)